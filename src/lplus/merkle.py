@@ -0,0 +1,36 @@
+from typing import List
+from functools import cache
+import hashlib
+
+# https://www.bittorrent.org/beps/bep_0052.html
+
+BLOCK_SIZE = 2**14 # leaf size of the v2 merkle trees
+HASH_SIZE = 32
+MAX_HASHES_PER_REQUEST = 512 # peers may reject hash requests longer than this
+
+def sha256(data: bytes) -> bytes:
+	return hashlib.sha256(data).digest()
+
+def next_pow2(n: int) -> int:
+	return 1 << max(n - 1, 0).bit_length()
+
+# the hash of an all-padding subtree whose leaves sit `layer` layers below it
+@cache
+def pad_hash(layer: int) -> bytes:
+	if layer == 0:
+		return bytes(HASH_SIZE) # padding leaves are zeroes, *not* the hash of zeroes
+	child = pad_hash(layer - 1)
+	return sha256(child + child)
+
+def block_hashes(data: bytes) -> List[bytes]:
+	# the final block of a file is hashed as-is, without padding
+	return [sha256(data[i:i+BLOCK_SIZE]) for i in range(0, len(data), BLOCK_SIZE)]
+
+# width is the padded number of hashes in the base layer, and must be a power of two
+def merkle_root(hashes: List[bytes], width: int, base_layer: int=0) -> bytes:
+	if width & (width - 1) or len(hashes) > width:
+		raise ValueError("bad merkle tree width")
+	layer = hashes + [pad_hash(base_layer)] * (width - len(hashes))
+	while len(layer) > 1:
+		layer = [sha256(layer[i] + layer[i+1]) for i in range(0, len(layer), 2)]
+	return layer[0]
@@ -1,52 +1,152 @@
 from dataclasses import dataclass
-from typing import BinaryIO, List
+from typing import BinaryIO, List, Optional, Tuple
 import hashlib
 
 from . import bencode
+from . import merkle
 
 @dataclass
 class Info:
 	name: str
 	piece_length: int
-	pieces: List[bytes]
 	length: int
+	pieces: Optional[List[bytes]] = None # v1 SHA-1 piece hashes
+	pieces_root: Optional[bytes] = None # v2 SHA-256 merkle root of the file
 	# TODO: handle multi-file case
 
+	@property
+	def has_v1(self) -> bool:
+		return self.pieces is not None
+
+	@property
+	def has_v2(self) -> bool:
+		return self.pieces_root is not None
+
+	@property
+	def num_pieces(self) -> int:
+		return (self.length + self.piece_length - 1) // self.piece_length # round up
+
+	@property
+	def blocks_per_piece(self) -> int:
+		return self.piece_length // merkle.BLOCK_SIZE
+
+	def piece_size(self, index: int) -> int:
+		return min(self.piece_length, self.length - (index * self.piece_length))
+
 	@classmethod
 	def from_dict(cls, value: dict):
 		name = value[b"name"].decode()
 		piece_length = value[b"piece length"]
-		pieces_raw = value[b"pieces"]
-		length = value[b"length"]
 		assert(piece_length > 0)
+
+		length = None
+		pieces = None
+		if b"pieces" in value:
+			pieces_raw = value[b"pieces"]
+			length = value[b"length"]
+			assert(type(pieces_raw) is bytes)
+			assert((len(pieces_raw) % 20) == 0)
+			pieces = [pieces_raw[i:i+20] for i in range(0, len(pieces_raw), 20)]
+
+		pieces_root = None
+		if value.get(b"meta version") == 2:
+			# v2 pieces must be a power of two, and at least one block
+			assert(piece_length >= merkle.BLOCK_SIZE)
+			assert(piece_length & (piece_length - 1) == 0)
+			files = parse_file_tree(value[b"file tree"])
+			assert(len(files) == 1) # TODO: handle multi-file case
+			path, file_length, pieces_root = files[0]
+			assert(path == [name])
+			if length is not None: # hybrid torrent, both halves must describe the same file
+				assert(file_length == length)
+			length = file_length
+
+		assert(pieces is not None or pieces_root is not None)
 		assert(length >= 0)
-		assert(type(pieces_raw) is bytes)
-		assert((len(pieces_raw) % 20) == 0)
-		pieces = [pieces_raw[i:i+20] for i in range(0, len(pieces_raw), 20)]
-		expected_piece_count = (length + piece_length - 1) // piece_length # round up
-		assert(len(pieces) == expected_piece_count)
-		return cls(
+		info = cls(
 			name=name,
 			piece_length=piece_length,
-			pieces=pieces,
 			length=length,
+			pieces=pieces,
+			pieces_root=pieces_root,
 		)
+		if pieces is not None:
+			assert(len(pieces) == info.num_pieces)
+		return info
+
+
+# returns a flat list of (path, length, pieces root) tuples
+def parse_file_tree(tree: dict, path: List[str]=[]) -> List[Tuple[List[str], int, bytes]]:
+	files = []
+	for k, v in tree.items():
+		if k == b"": # leaf node, describing the file at the current path
+			assert(path)
+			length = v[b"length"]
+			assert(length > 0) # TODO: empty files don't have a pieces root
+			pieces_root = v[b"pieces root"]
+			assert(type(pieces_root) is bytes)
+			assert(len(pieces_root) == merkle.HASH_SIZE)
+			files.append((path, length, pieces_root))
+		else:
+			files += parse_file_tree(v, path + [k.decode()])
+	return files
 
 
 @dataclass
 class MetaInfo:
 	announce: str
 	info: Info
-	info_hash: bytes
+	info_hash: bytes # the 20-byte hash used on the wire and with trackers
+	info_hash_v2: Optional[bytes] = None
+	piece_layer: Optional[List[bytes]] = None # v2 hashes, one per piece (absent for single-piece files)
 
 	@classmethod
 	def from_bencoded(cls, stream: BinaryIO):
 		parsed = bencode.parse(stream)
 		info_dict = parsed[b"info"]
 		info_bytes = bencode.serialise(info_dict)
-		info_hash = hashlib.sha1(info_bytes).digest()
+		info = Info.from_dict(info_dict)
+
+		info_hash_v2 = None
+		piece_layer = None
+		if info.has_v2:
+			info_hash_v2 = hashlib.sha256(info_bytes).digest()
+			if info.length > info.piece_length:
+				layer_raw = parsed[b"piece layers"][info.pieces_root]
+				assert(type(layer_raw) is bytes)
+				assert(len(layer_raw) == info.num_pieces * merkle.HASH_SIZE)
+				piece_layer = [layer_raw[i:i+merkle.HASH_SIZE] for i in range(0, len(layer_raw), merkle.HASH_SIZE)]
+				layer_root = merkle.merkle_root(
+					piece_layer,
+					merkle.next_pow2(len(piece_layer)),
+					base_layer=info.blocks_per_piece.bit_length() - 1
+				)
+				if layer_root != info.pieces_root:
+					raise ValueError("piece layer does not match pieces root")
+
+		# hybrid torrents keep using the v1 infohash, v2-only torrents use a truncated v2 one
+		if info.has_v1:
+			info_hash = hashlib.sha1(info_bytes).digest()
+		else:
+			info_hash = info_hash_v2[:20]
+
 		return cls(
 			announce=parsed[b"announce"].decode(),
-			info=Info.from_dict(info_dict),
-			info_hash=info_hash
+			info=info,
+			info_hash=info_hash,
+			info_hash_v2=info_hash_v2,
+			piece_layer=piece_layer,
 		)
+
+	# returns the hash covering a v2 piece, and the (padded) number of block hashes beneath it
+	def piece_subtree(self, index: int) -> Tuple[bytes, int]:
+		if self.piece_layer is None: # the whole file fits in a single piece
+			num_blocks = (self.info.length + merkle.BLOCK_SIZE - 1) // merkle.BLOCK_SIZE
+			return self.info.pieces_root, merkle.next_pow2(num_blocks)
+		return self.piece_layer[index], self.info.blocks_per_piece
+
+	def check_piece(self, index: int, piece: bytes) -> bool:
+		if self.info.has_v2:
+			expected, width = self.piece_subtree(index)
+			return merkle.merkle_root(merkle.block_hashes(piece), width) == expected
+		return hashlib.sha1(piece).digest() == self.info.pieces[index]
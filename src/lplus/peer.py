@@ -1,6 +1,6 @@
 import asyncio
 from enum import Enum
-from typing import BinaryIO, Self, Set, Tuple, Dict, TYPE_CHECKING
+from typing import BinaryIO, Self, Set, Tuple, Dict, List, Optional, TYPE_CHECKING
 from dataclasses import dataclass
 
 from .metainfo import MetaInfo
@@ -20,8 +20,15 @@ class MsgType(Enum):
 	REQUEST = 6
 	PIECE = 7
 	CANCEL = 8
+	HASH_REQUEST = 21
+	HASHES = 22
+	HASH_REJECT = 23
 
 PROTOCOL_MAGIC = b"\x13BitTorrent protocol"
+RESERVED_V2_BIT = 0x10 # in the last reserved byte, signals BEP 52 support
+
+# (pieces root, base layer, index, length, proof layers)
+HashRequest = Tuple[bytes, int, int, int, int]
 
 @dataclass(frozen=True)
 class PeerInfo:
@@ -39,6 +46,7 @@ class PeerSession:
 
 	peer_choked: bool = True
 	peer_interested: bool = False
+	supports_v2: bool = False
 
 	inflight_requests: Dict[Tuple[int, int, int], asyncio.Queue[bytes]] = {} # (index, begin, length)
 
@@ -47,7 +55,8 @@ class PeerSession:
 		self.peer = peer
 		self.timeout = timeout
 
-		self.peer_pieces = Bitmap(len(self.ts.meta.info.pieces))
+		self.inflight_hash_requests: Dict[HashRequest, asyncio.Queue[Optional[List[bytes]]]] = {}
+		self.peer_pieces = Bitmap(self.ts.meta.info.num_pieces)
 
 	async def request(self, index: int, begin: int, length: int) -> bytes:
 		req = (index, begin, length)
@@ -63,6 +72,23 @@ class PeerSession:
 		finally:
 			del self.inflight_requests[req]
 
+	async def request_hashes(self, pieces_root: bytes, base_layer: int, index: int, length: int, proof_layers: int=0) -> List[bytes]:
+		req = (pieces_root, base_layer, index, length, proof_layers)
+		if req in self.inflight_hash_requests:
+			raise Exception("there's a hash request for that already in-flight")
+		q = asyncio.Queue()
+		self.inflight_hash_requests[req] = q
+		try:
+			async with asyncio.timeout(self.timeout):
+				await self._send_message(MsgType.HASH_REQUEST, _pack_hash_request(req))
+				print(self.peer, "sent hash request")
+				hashes = await q.get()
+		finally:
+			del self.inflight_hash_requests[req]
+		if hashes is None:
+			raise ValueError("hash request rejected")
+		return hashes
+
 	async def set_choked(self, is_choked: bool):
 		await self._send_message(MsgType.CHOKE if is_choked else MsgType.UNCHOKE, b"")
 
@@ -93,7 +119,8 @@ class PeerSession:
 	
 	async def _handshake(self) -> None:
 		self.writer.write(PROTOCOL_MAGIC)
-		self.writer.write(bytes(8)) # reserved bytes
+		self.writer.write(bytes(7)) # reserved bytes
+		self.writer.write(bytes([RESERVED_V2_BIT if self.ts.meta.info.has_v2 else 0]))
 		self.writer.write(self.ts.meta.info_hash)
 		self.writer.write(self.ts.peer_id)
 		
@@ -101,8 +128,9 @@ class PeerSession:
 		if magic_recv != PROTOCOL_MAGIC:
 			raise ValueError("handshake: bad magic")
 		rsvd = await self.reader.readexactly(8)
-		if any(rsvd):
+		if any(rsvd[:7]) or rsvd[7] & ~RESERVED_V2_BIT:
 			print(self.peer, "WARNING: nonzero reserved bytes:", rsvd.hex())
+		self.supports_v2 = self.ts.meta.info.has_v2 and bool(rsvd[7] & RESERVED_V2_BIT)
 		hash_recv = await self.reader.readexactly(20)
 		if hash_recv != self.ts.meta.info_hash:
 			raise ValueError("handshake infohash did not match")
@@ -166,6 +194,27 @@ class PeerSession:
 					self.inflight_requests[request].put_nowait(piece)
 				elif msgtype == MsgType.CANCEL:
 					pass # TODO: care about this
+				elif msgtype == MsgType.HASH_REQUEST:
+					assert(len(payload) == 48)
+					# TODO: serve hashes for pieces we have
+					await self._send_message(MsgType.HASH_REJECT, payload)
+				elif msgtype == MsgType.HASHES:
+					assert(len(payload) >= 48)
+					request = _unpack_hash_request(payload[:48])
+					hashes_raw = payload[48:]
+					assert(len(hashes_raw) % 32 == 0)
+					hashes = [hashes_raw[i:i+32] for i in range(0, len(hashes_raw), 32)]
+					if request not in self.inflight_hash_requests:
+						print(self.peer, "received hashes we weren't expecting, discarding")
+						continue
+					length = request[3]
+					assert(len(hashes) >= length) # any proof hashes come after the base layer
+					self.inflight_hash_requests[request].put_nowait(hashes[:length])
+				elif msgtype == MsgType.HASH_REJECT:
+					assert(len(payload) == 48)
+					request = _unpack_hash_request(payload)
+					if request in self.inflight_hash_requests:
+						self.inflight_hash_requests[request].put_nowait(None)
 				else:
 					raise NotImplementedError(f"unreachable??? {msgtype}")
 		finally:
@@ -173,3 +222,10 @@ class PeerSession:
 
 	def print_status(self):
 		print(f"{self.peer} up:{self.uploaded} down:{self.downloaded} {self.peer_pieces.num_set_bits / self.peer_pieces.length * 100:.2f}%")
+
+
+def _pack_hash_request(req: HashRequest) -> bytes:
+	return req[0] + b"".join(i.to_bytes(4, "big") for i in req[1:])
+
+def _unpack_hash_request(payload: bytes) -> HashRequest:
+	return (payload[:32], *(int.from_bytes(payload[i:i+4], "big") for i in range(32, 48, 4)))
@@ -1,5 +1,5 @@
 import hashlib
-from typing import Self, Dict
+from typing import Self, Dict, List
 import random
 import asyncio
 import time
@@ -11,6 +11,7 @@ from tqdm import tqdm
 from .metainfo import MetaInfo
 from . import tracker
 from . import peer
+from . import merkle
 from .bitmap import Bitmap
 
 
@@ -27,9 +28,13 @@ class TorrentSession:
 		print("length:       ", self.meta.info.length)
 		print("piece length: ", self.meta.info.piece_length)
 		print("infohash:     ", self.meta.info_hash.hex())
+		if self.meta.info.has_v2:
+			print("infohash (v2):", self.meta.info_hash_v2.hex())
 		print()
 
-		self.saved_pieces = Bitmap(len(self.meta.info.pieces))
+		self.saved_pieces = Bitmap(self.meta.info.num_pieces)
+		self.leaf_hashes: Dict[int, List[bytes]] = {} # verified v2 block hashes, per piece
+		self.saved_blocks: Dict[int, Bitmap] = {} # v2 blocks already on disk, for partially saved pieces
 		self.peer_id = os.urandom(20)
 		self.start_time = time.time()
 
@@ -49,11 +54,10 @@ class TorrentSession:
 		self.file.seek(0)
 
 		# TODO: make this async
-		for i, expected in tqdm(enumerate(self.meta.info.pieces), desc="Verifying local pieces"):
+		for i in tqdm(range(self.meta.info.num_pieces), desc="Verifying local pieces"):
 			#self.file.seek(i * self.meta.info.piece_length)
 			piece = self.file.read(self.meta.info.piece_length) # last read will be truncated
-			hash_now = hashlib.sha1(piece).digest()
-			self.saved_pieces[i] = hash_now == expected
+			self.saved_pieces[i] = self.meta.check_piece(i, piece)
 		
 		print(f"{self.saved_pieces.num_set_bits}/{self.saved_pieces.length} pieces already saved")
 		#exit()
@@ -107,7 +111,7 @@ class TorrentSession:
 
 	async def leech_workloop(self):
 		# TODO: use a proper queue
-		pieces_to_download = list(range(len(self.meta.info.pieces)))
+		pieces_to_download = list(range(self.meta.info.num_pieces))
 		random.shuffle(pieces_to_download)
 		while pieces_to_download:
 			current_piece = pieces_to_download.pop(0)
@@ -117,7 +121,8 @@ class TorrentSession:
 			peers = list(self.peer_sessions.items())
 			random.shuffle(peers) # randomise which peers we're leeching from
 			for peerinfo, peer_session in peers:
-				if not peer_session.peer_choked and (current_piece in peer_session.peer_pieces):
+				can_verify = self.meta.info.has_v1 or peer_session.supports_v2
+				if can_verify and not peer_session.peer_choked and (current_piece in peer_session.peer_pieces):
 					break
 			else:
 				print(f"could not find peer offering piece {current_piece}, putting it back in the queue")
@@ -129,15 +134,10 @@ class TorrentSession:
 
 			# TODO: concurrent piece downloads from multiple peers
 			try:
-				expected_piece_length = min(self.meta.info.piece_length, self.meta.info.length - (current_piece * self.meta.info.piece_length))
-				tasks = []
-				for i in range(0, expected_piece_length, 2**14):
-					length_to_read = min(2**14, expected_piece_length - i)
-					#print("trying to read", length_to_read)
-					tasks.append(peer_session.request(current_piece, i, length_to_read))
-				results = await asyncio.gather(*tasks)
-				piece = b"".join(results)
-				assert(len(piece) == expected_piece_length)
+				if peer_session.supports_v2:
+					success = await self.download_piece_v2(peer_session, current_piece)
+				else:
+					success = await self.download_piece_v1(peer_session, current_piece)
 			except TimeoutError:
 				print("timeout!")
 				if peer_session.recv_task.done():
@@ -151,19 +151,10 @@ class TorrentSession:
 				pieces_to_download.append(current_piece)
 				continue
 
-			hash_calc = hashlib.sha1(piece).digest()
-
-			if hash_calc != self.meta.info.pieces[current_piece]:
-				print("hash calc failed!!!") # TODO: drop the peer?
-				print(f"calculated piece hash {hash_calc.hex()}")
-				print(f"expected piece hash {self.meta.info.pieces[current_piece].hex()}")
+			if not success:
 				pieces_to_download.append(current_piece)
 				continue
 
-			print(f"saving {len(piece)} bytes to offset {current_piece * self.meta.info.piece_length}")
-			self.file.seek(current_piece * self.meta.info.piece_length)
-			self.file.write(piece)
-			self.file.flush()
 			self.saved_pieces[current_piece] = True
 
 			# TODO: tell the peers we got the piece
@@ -171,3 +162,89 @@ class TorrentSession:
 		print("All pieces downloaded!!!")
 		while True:
 			await asyncio.sleep(1)
+
+	async def download_piece_v1(self, peer_session: peer.PeerSession, index: int) -> bool:
+		expected_piece_length = self.meta.info.piece_size(index)
+		tasks = []
+		for i in range(0, expected_piece_length, 2**14):
+			length_to_read = min(2**14, expected_piece_length - i)
+			#print("trying to read", length_to_read)
+			tasks.append(peer_session.request(index, i, length_to_read))
+		results = await asyncio.gather(*tasks)
+		piece = b"".join(results)
+		assert(len(piece) == expected_piece_length)
+
+		hash_calc = hashlib.sha1(piece).digest()
+
+		if hash_calc != self.meta.info.pieces[index]:
+			print("hash calc failed!!!") # TODO: drop the peer?
+			print(f"calculated piece hash {hash_calc.hex()}")
+			print(f"expected piece hash {self.meta.info.pieces[index].hex()}")
+			return False
+
+		print(f"saving {len(piece)} bytes to offset {index * self.meta.info.piece_length}")
+		self.file.seek(index * self.meta.info.piece_length)
+		self.file.write(piece)
+		self.file.flush()
+		return True
+
+	# v2 pieces are verified (and saved) one block at a time, so a bad block only costs itself
+	async def download_piece_v2(self, peer_session: peer.PeerSession, index: int) -> bool:
+		if index not in self.leaf_hashes:
+			hashes = await self.fetch_leaf_hashes(peer_session, index)
+			if hashes is None:
+				return False
+			self.leaf_hashes[index] = hashes
+
+		leaf_hashes = self.leaf_hashes[index]
+		expected_piece_length = self.meta.info.piece_size(index)
+		num_blocks = (expected_piece_length + merkle.BLOCK_SIZE - 1) // merkle.BLOCK_SIZE
+		saved_blocks = self.saved_blocks.setdefault(index, Bitmap(num_blocks))
+		piece_offset = index * self.meta.info.piece_length
+
+		async def download_block(block_index: int) -> None:
+			begin = block_index * merkle.BLOCK_SIZE
+			block = await peer_session.request(index, begin, min(merkle.BLOCK_SIZE, expected_piece_length - begin))
+			if merkle.sha256(block) != leaf_hashes[block_index]:
+				print(f"hash calc failed for block {block_index} of piece {index}") # TODO: drop the peer?
+				return
+			self.file.seek(piece_offset + begin)
+			self.file.write(block)
+			saved_blocks[block_index] = True
+
+		await asyncio.gather(*(download_block(i) for i in range(num_blocks) if i not in saved_blocks))
+		self.file.flush()
+
+		if saved_blocks.num_set_bits != num_blocks:
+			return False # we'll retry just the missing blocks
+
+		print(f"saved piece {index} ({expected_piece_length} bytes)")
+		del self.leaf_hashes[index]
+		del self.saved_blocks[index]
+		return True
+
+	# returns None if the peer rejected the request or sent us bad hashes
+	async def fetch_leaf_hashes(self, peer_session: peer.PeerSession, index: int) -> List[bytes] | None:
+		expected, width = self.meta.piece_subtree(index)
+		if width == 1: # the piece is a single block, its hash is already known
+			return [expected]
+		hashes = []
+		chunk_length = min(width, merkle.MAX_HASHES_PER_REQUEST)
+		try:
+			for i in range(0, width, chunk_length):
+				hashes += await peer_session.request_hashes(
+					self.meta.info.pieces_root,
+					0, # base layer (i.e. the leaves)
+					index * self.meta.info.blocks_per_piece + i,
+					chunk_length
+				)
+		except ValueError as e:
+			print(e)
+			return None
+		root_calc = merkle.merkle_root(hashes, width)
+		if root_calc != expected:
+			print("hash calc failed for block hashes!!!") # TODO: drop the peer?
+			print(f"calculated piece hash {root_calc.hex()}")
+			print(f"expected piece hash {expected.hex()}")
+			return None
+		return hashes